@@ -0,0 +1,154 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+import sqlite3
+import threading
+import time
+
+try:
+    import queue
+except ImportError:
+    import Queue as queue
+
+SCHEMA = [
+    'CREATE TABLE IF NOT EXISTS events ('
+    ' id INTEGER PRIMARY KEY,'
+    ' repo TEXT NOT NULL,'
+    ' event_type TEXT NOT NULL,'
+    ' received_at REAL NOT NULL,'
+    ' message TEXT NOT NULL)',
+    'CREATE INDEX IF NOT EXISTS events_repo_time '
+    'ON events (repo, received_at)',
+    'CREATE INDEX IF NOT EXISTS events_repo_event_time '
+    'ON events (repo, event_type, received_at)',
+    'CREATE INDEX IF NOT EXISTS events_time ON events (received_at)',
+]
+
+# Upper bound of events written in a single transaction.
+BATCH_SIZE = 500
+# Upper bound of events waiting to be written, more are dropped.
+QUEUE_SIZE = 10000
+
+_COMPACT = object()
+_STOP = object()
+
+
+class EventArchive(object):
+    """Append-only archive of the messages rendered for incoming events.
+
+    Events are handed to a writer thread through a queue so recording one
+    never blocks the webhook. The table is indexed on repository, event type
+    and time so history queries only touch the rows they return, whatever
+    the size of the archive. Events older than the retention are dropped
+    when the archive is compacted.
+    """
+
+    def __init__(self, path, retention, log):
+        self.path = path
+        self.retention = retention
+        self.log = log
+        self.queue = queue.Queue(maxsize=QUEUE_SIZE)
+        self.writer = None
+
+    def connect(self):
+        connection = sqlite3.connect(self.path)
+        connection.execute('PRAGMA journal_mode=WAL')
+        return connection
+
+    def start(self):
+        """Create the schema if needed and start the writer thread."""
+        connection = self.connect()
+        with connection:
+            for statement in SCHEMA:
+                connection.execute(statement)
+        connection.close()
+        self.writer = threading.Thread(target=self.write, name='RepoHookArchive')
+        self.writer.daemon = True
+        self.writer.start()
+
+    def stop(self):
+        """Flush pending events and stop the writer thread."""
+        if self.writer is not None:
+            self.queue.put(_STOP)
+            self.writer.join()
+            self.writer = None
+
+    def record(self, repo, event_type, message):
+        """Queue an event for archival, drop it if the writer can't keep
+        up."""
+        try:
+            self.queue.put_nowait((repo, event_type, time.time(), message))
+        except queue.Full:
+            self.log.warn('Archive queue is full, dropping {0} event for '
+                          '{1}'.format(event_type, repo))
+
+    def compact(self):
+        """Queue the removal of events older than the retention."""
+        try:
+            self.queue.put_nowait(_COMPACT)
+        except queue.Full:
+            self.log.warn('Archive queue is full, skipping compaction')
+
+    def write(self):
+        connection = self.connect()
+        try:
+            while True:
+                item = self.queue.get()
+                events = []
+                while item is not _STOP and item is not _COMPACT:
+                    events.append(item)
+                    if len(events) == BATCH_SIZE:
+                        break
+                    try:
+                        item = self.queue.get_nowait()
+                    except queue.Empty:
+                        item = None
+                        break
+                # A full disk or a database locked by another instance
+                # costs us these events, not the writer.
+                if events:
+                    try:
+                        with connection:
+                            connection.executemany(
+                                'INSERT INTO events (repo, event_type, '
+                                'received_at, message) VALUES (?, ?, ?, ?)',
+                                events)
+                    except sqlite3.Error as e:
+                        self.log.error('Could not archive {0} events: '
+                                       '{1}'.format(len(events), e))
+                if item is _COMPACT:
+                    try:
+                        with connection:
+                            connection.execute(
+                                'DELETE FROM events WHERE received_at < ?',
+                                (time.time() - self.retention, ))
+                    except sqlite3.Error as e:
+                        self.log.error('Could not compact the archive: '
+                                       '{0}'.format(e))
+                elif item is _STOP:
+                    break
+        finally:
+            connection.close()
+
+    def query(self, repo, event_type=None, since=None, limit=20):
+        """Return the most recent events of a repository, newest first.
+
+        Every event is returned as a (received_at, event_type, message)
+        tuple. Optionally only events of event_type or received after the
+        timestamp since are returned.
+        """
+        sql = ['SELECT received_at, event_type, message FROM events '
+               'WHERE repo = ?']
+        params = [repo]
+        if event_type is not None:
+            sql.append('AND event_type = ?')
+            params.append(event_type)
+        if since is not None:
+            sql.append('AND received_at >= ?')
+            params.append(since)
+        sql.append('ORDER BY received_at DESC LIMIT ?')
+        params.append(limit)
+        connection = self.connect()
+        try:
+            return connection.execute(' '.join(sql), params).fetchall()
+        finally:
+            connection.close()
@@ -1,5 +1,7 @@
 import hashlib
 import hmac
+import os
+from collections import Counter
 
 from errbot.templating import tenv
 
@@ -14,21 +16,149 @@ DEFAULT_EVENTS = ['commit_comment', 'issue_comment', 'issues', 'pull_request_rev
                   'pull_request', 'push', 'push_hook', 'tag_push_hook', 'issue_hook',
                   'note_hook', 'merge_request_hook']
 
+# Commits listed in a push message, unless the route says otherwise.
+COMMIT_LIMIT = 5
+# No route lists more commits than this, whatever it is configured to.
+MAX_COMMIT_LIMIT = 50
+# Commit messages are cut down to their first line of at most this length.
+COMMIT_MESSAGE_LENGTH = 120
+# At most this many commits are looked at to aggregate authors and paths,
+# of which the most common few are mentioned.
+AGGREGATE_LIMIT = 500
+AGGREGATE_TOP = 3
+AGGREGATES = ['authors', 'paths']
+
+TEMPLATE_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                            'templates')
+
+# Providers in the order in which their event header is looked for.
+PROVIDERS = []
+
+
+def register_provider(cls):
+    """Class decorator that compiles a provider's handler table and adds
+    the provider to the registry.
+
+    Every `msg_<event>` method becomes the handler for `<event>`, events
+    listed in `event_aliases` share the handler of the event they map to,
+    and so does their membership of `summarized_events`.
+    Doing this once at import means dispatching an event is a single dict
+    lookup.
+    """
+    handlers = {}
+    for attr in dir(cls):
+        if attr.startswith('msg_') and attr != 'msg_generic':
+            handlers[attr[len('msg_'):]] = getattr(cls, attr)
+    for alias, event_type in cls.event_aliases.items():
+        if event_type in handlers:
+            handlers[alias] = handlers[event_type]
+    cls.handlers = handlers
+    cls.summarized = set(event for event in handlers
+                         if cls.event_aliases.get(event, event)
+                         in cls.summarized_events)
+    PROVIDERS.append(cls)
+    return cls
+
+
+def precompile_templates():
+    """Compile every template shipped with the plugin.
+
+    The templating environment caches compiled templates so rendering the
+    first message of each type doesn't pay for the compilation. Returns the
+    number of templates compiled.
+    """
+    env = tenv()
+    templates = [name for name in os.listdir(TEMPLATE_DIR)
+                 if name.endswith('.html')]
+    for name in templates:
+        env.get_template(name)
+    return len(templates)
+
+
+def summarize_commits(commits, total=None, limit=COMMIT_LIMIT, aggregate=()):
+    """Reduce the commits of a push to what fits in a message.
+
+    Only the first limit commits, and never more than MAX_COMMIT_LIMIT, are
+    listed and the number of commits left out is returned as more. With
+    'authors' or 'paths' in aggregate the most common authors and top-level
+    directories are counted as well, over at most AGGREGATE_LIMIT commits,
+    so a huge push costs no more to render than a big one. When that's not
+    all of them, the number of commits counted is returned as sampled.
+    """
+    if total is None:
+        total = len(commits)
+    limit = min(limit, MAX_COMMIT_LIMIT)
+    sampled = None
+    commit_messages = [
+        dict(hash=c['id'][:8], url=c['url'],
+             msg=c['message'].split('\n', 1)[0][:COMMIT_MESSAGE_LENGTH])
+        for c in commits[:limit]
+    ]
+    authors = []
+    paths = []
+    counted = min(len(commits), AGGREGATE_LIMIT)
+    if aggregate and counted < total:
+        sampled = counted
+    if 'authors' in aggregate:
+        authors = Counter(
+            c['author']['name'] for c in commits[:AGGREGATE_LIMIT]
+        ).most_common(AGGREGATE_TOP)
+    if 'paths' in aggregate:
+        counter = Counter()
+        for c in commits[:AGGREGATE_LIMIT]:
+            counter.update(set(
+                path.split('/', 1)[0] if '/' in path else '/'
+                for key in ('added', 'modified', 'removed')
+                for path in c.get(key, [])))
+        paths = counter.most_common(AGGREGATE_TOP)
+    return dict(commits=total, commit_messages=commit_messages,
+                more=max(total - len(commit_messages), 0),
+                authors=authors, paths=paths, sampled=sampled)
+
 
 class CommonGitWebProvider(object):
-    def create_message(self, body, event_type, repo):
+    name = None
+    # Header carrying the event type, the presence of which identifies the
+    # provider, and the header carrying the signature of the payload.
+    event_header = None
+    signature_header = None
+    # Header carrying the unique ID of a delivery, if the provider sends one.
+    delivery_header = None
+    # Provider specific event types mapped to the name of their handler.
+    event_aliases = {}
+    # Events whose handler takes summary settings, see summarize_commits.
+    summarized_events = ()
+    handlers = {}
+    summarized = set()
+
+    @classmethod
+    def get_event_type(cls, request):
+        """Return the normalised event type of the incoming request."""
+        return request.get_header(cls.event_header).replace(' ', '_').lower()
+
+    @classmethod
+    def get_delivery_id(cls, request):
+        """Return the unique ID of the incoming delivery or None."""
+        if cls.delivery_header is None:
+            return None
+        return request.get_header(cls.delivery_header)
+
+    def create_message(self, body, event_type, repo, summary=None):
         """
-        Dispatch the message. Check explicitly with hasattr first. When
-        using a try/catch with AttributeError errors in the
-        message_function which result in an AttributeError would cause
-        us to call msg_generic, which is not what we want.
+        Dispatch the message through the handler table compiled by
+        register_provider. If there is no handler for this event, use the
+        generic message function.
+
+        Summary settings, the keyword arguments of summarize_commits, are
+        passed on to the handlers of the events in summarized.
         """
-        message_function = 'msg_{0}'.format(event_type)
-        if hasattr(self, message_function):
-            message = getattr(self, message_function)(body, repo)
-        else:
-            message = self.msg_generic(body, repo, event_type)
-        return message
+        handler = self.handlers.get(event_type)
+        if handler is None:
+            return self.msg_generic(
+                body, repo, self.event_aliases.get(event_type, event_type))
+        if summary is not None and event_type in self.summarized:
+            return handler(self, body, repo, summary=summary)
+        return handler(self, body, repo)
 
     def render_template(self, template='generic', **kwargs):
         kwargs['repo_name'] = kwargs.get('repo_name') or self.name
@@ -39,8 +169,13 @@ class CommonGitWebProvider(object):
             template='generic', body=body, repo=repo, event_type=event_type)
 
 
+@register_provider
 class GithubHandlers(CommonGitWebProvider):
     name = 'Github'
+    event_header = 'X-Github-Event'
+    signature_header = 'X-Hub-Signature'
+    delivery_header = 'X-Github-Delivery'
+    summarized_events = ('push', )
 
     @staticmethod
     def valid_message(request, token):
@@ -50,7 +185,7 @@ class GithubHandlers(CommonGitWebProvider):
         """
         # TODO: Fix GitLab token validation:
         #       https://docs.gitlab.com/ce/web_hooks/web_hooks.html#secret-token
-        signature = request.get_header('X-Hub-Signature')
+        signature = request.get_header(GithubHandlers.signature_header)
 
         if signature is None:
             return False
@@ -120,7 +255,7 @@ class GithubHandlers(CommonGitWebProvider):
             text=body['comment']['body']
         )
 
-    def msg_push(self, body, repo):
+    def msg_push(self, body, repo, summary=None):
         if body['created']:
             action = 'created'
         elif body['deleted']:
@@ -132,13 +267,10 @@ class GithubHandlers(CommonGitWebProvider):
         return self.render_template(
             template='push', body=body, repo=repo,
             user=body['pusher']['name'],
-            commits=len(body['commits']),
             branch=body['ref'].split('/')[-1],
             url=body['compare'],
             action=action,
-            commit_messages=[dict(hash=c['id'][:8], url=c['url'],
-                                  msg=c['message']
-                                ) for c in body['commits'][:5]]
+            **summarize_commits(body['commits'], **(summary or {}))
         )
 
     def msg_status(*args):
@@ -175,8 +307,19 @@ class GithubHandlers(CommonGitWebProvider):
         )
 
 
+@register_provider
 class GitLabHandlers(CommonGitWebProvider):
     name = 'GitLab'
+    event_header = 'X-Gitlab-Event'
+    signature_header = 'X-Gitlab-Token'
+    delivery_header = 'X-Gitlab-Event-UUID'
+    summarized_events = ('push', )
+    event_aliases = {
+        'push_hook': 'push',
+        'issue_hook': 'issue',
+        'note_hook': 'comment',
+        'merge_request_hook': 'pull_request',
+    }
 
     @staticmethod
     def valid_message(request, token):
@@ -186,7 +329,7 @@ class GitLabHandlers(CommonGitWebProvider):
         # TODO: Fix GitLab token validation:
         #       https://docs.gitlab.com/ce/web_hooks/web_hooks.html#secret-token
         """
-        signature = request.get_header('X-Gitlab-Token')
+        signature = request.get_header(GitLabHandlers.signature_header)
         return True
 
     def get_repo(self, body):
@@ -195,42 +338,26 @@ class GitLabHandlers(CommonGitWebProvider):
         else:
             return body['project_name'].replace(' ', '')
 
-    def map_event_type(self, event_type):
-        return {
-            'push_hook': 'push',
-            'issue_hook': 'issue',
-            'note_hook': 'comment',
-            'merge_request_hook': 'pull_request',
-        }.get(event_type, event_type)
-
-    def create_message(self, body, event_type, repo):
-        mapped_event_type = self.map_event_type(event_type)
-        return super(GitLabHandlers, self).create_message(body, mapped_event_type, repo)
-
-    def msg_push(self, body, repo):
+    def msg_push(self, body, repo, summary=None):
         if body['commits']:
             url = body['project']['web_url'] + '/compare/' + body['before'][:8] + '...' + body['after'][:8]
             action = "pushed"
-            commit_messages = [
-                dict(msg=c['message'], hash=c['id'][:8],
-                     url=c['url']) for c in body['commits']
-            ]
         else:
             if body['before'][:8] == '00000000':
                 action = 'created'
             if body['after'][:8] == '00000000':
                 action = 'deleted'
             url = body['project']['web_url']
-            commit_messages = []
 
+        # GitLab only sends the first 20 commits but counts all of them.
         return self.render_template(
             template='push', body=body, repo=repo,
             user=body['user_name'],
-            commits=len(body['commits']),
             branch='/'.join(body['ref'].split('/')[2:]),
             url=url,
-            commit_messages=commit_messages,
-            action=action
+            action=action,
+            **summarize_commits(body['commits'], body.get('total_commits_count'),
+                                **(summary or {}))
         )
 
     def msg_issue(self, body, repo):
@@ -1,6 +1,13 @@
 # -*- coding: utf-8 -*-
 from __future__ import unicode_literals
+import bisect
+import copy
+import hashlib
 import json
+import os
+import re
+import threading
+import time
 
 from bottle import abort, response
 from errbot import BotPlugin, botcmd, webhook
@@ -9,20 +16,48 @@ import errbot.backends.base
 
 import config
 
-from providers import GitLabHandlers, GithubHandlers, SUPPORTED_EVENTS, DEFAULT_EVENTS
+from archive import EventArchive
+from providers import PROVIDERS, SUPPORTED_EVENTS, DEFAULT_EVENTS, precompile_templates, \
+    AGGREGATES, COMMIT_LIMIT, MAX_COMMIT_LIMIT
+from state import get_state
+
+# Provider specific event types mapped to the name events are archived as.
+EVENT_ALIASES = dict(alias for p in PROVIDERS for alias in p.event_aliases.items())
 
 DEFAULT_CONFIG = {'default_events': DEFAULT_EVENTS, 'repositories': {}, }
 
-REQUIRED_HEADERS = [('X-Github-Event', 'X-Gitlab-Event')]
+REQUIRED_HEADERS = [tuple(p.event_header for p in PROVIDERS)]
 VALIDATION_ENABLED = getattr(config, 'VALIDATE_SIGNATURE', True)
 if VALIDATION_ENABLED:
-    REQUIRED_HEADERS.append(('X-Hub-Signature', 'X-Gitlab-Token'), )
+    REQUIRED_HEADERS.append(tuple(p.signature_header for p in PROVIDERS), )
 
 HELP_MSG = ('Please see the output of `{0}repohook help` for usage '
             'and configuration instructions.'.format(config.BOT_PREFIX))
 
 REPO_UNKNOWN = 'The repository `{0}` is unknown to me.'
 EVENT_UNKNOWN = 'Unknown event `{0}`, skipping.'
+NEXT_PAGE = ('More repositories available, continue with '
+             '`{0}repohook {1} {2}`.')
+
+PAGE_SIZE = getattr(config, 'REPOHOOK_PAGE_SIZE', 20)
+
+ARCHIVE_PATH = getattr(config, 'REPOHOOK_ARCHIVE',
+                       os.path.join(config.BOT_DATA_DIR, 'repohook.db'))
+ARCHIVE_RETENTION = getattr(config, 'REPOHOOK_ARCHIVE_RETENTION', 7 * 86400)
+ARCHIVE_COMPACT_INTERVAL = 3600
+ARCHIVE_DISABLED = 'The event archive is disabled.'
+HISTORY_LIMIT = 20
+HISTORY_EMPTY = 'No events archived for `{0}`.'
+DURATION = re.compile(r'^(\d+)([smhdw])$')
+DURATION_UNITS = {'s': 1, 'm': 60, 'h': 3600, 'd': 86400, 'w': 604800}
+
+STATE_URL = getattr(config, 'REPOHOOK_STATE', None)
+DELIVERY_TTL = getattr(config, 'REPOHOOK_DELIVERY_TTL', 86400)
+LEASE_TTL = getattr(config, 'REPOHOOK_LEASE_TTL', 300)
+
+# Deliveries queued during the warm-up, more are refused with a 503 so the
+# provider retries them.
+PENDING_LIMIT = getattr(config, 'REPOHOOK_PENDING_LIMIT', 1000)
 
 README = 'https://github.com/daenney/err-repohook/blob/master/README.rst'
 
@@ -33,8 +68,88 @@ class RepoHook(BotPlugin):
 
     def __init__(self, *args, **kwargs):
         super(RepoHook, self).__init__(*args, **kwargs)
-        self.github = GithubHandlers()
-        self.gitlab = GitLabHandlers()
+        self.providers = [provider() for provider in PROVIDERS]
+        self.repo_index = []
+        self.route_index = {}
+        self.archive = None
+        # Route configuration, delivery deduplication and send leases live
+        # in the state backend so several instances can share the load.
+        self.state = get_state(STATE_URL)
+        self.config_version = None
+        # Deliveries received before the warm-up is done are queued in
+        # pending and dispatched once it finishes.
+        self.ready = False
+        self.ready_lock = threading.Lock()
+        self.pending = []
+        self.timings = {}
+
+    def activate(self):
+        started = time.time()
+        super(RepoHook, self).activate()
+        if ARCHIVE_PATH:
+            self.archive = EventArchive(ARCHIVE_PATH, ARCHIVE_RETENTION,
+                                        self.log)
+            self.archive.start()
+            self.start_poller(ARCHIVE_COMPACT_INTERVAL, self.archive.compact)
+        if 'global_route' in self:
+            # The global route used to be kept in this instance's storage,
+            # move it to the shared configuration.
+            room = self['global_route']
+            del self['global_route']
+            if room is not None and self.get_global_route() is None:
+                self.set_global_route(room)
+        self.ready = False
+        self.timings = {'activated_at': started}
+        warmup = threading.Thread(target=self.warm_up, name='RepoHookWarmUp')
+        warmup.daemon = True
+        warmup.start()
+        self.timings['activation'] = time.time() - started
+        self.log.info('Activated in {0:.3f}s, warming up in the '
+                      'background'.format(self.timings['activation']))
+
+    def warm_up(self):
+        """Compile the templates and build the route index, then dispatch
+        any delivery that was queued in the meantime.
+
+        Whatever goes wrong, the plugin is ready afterwards. Templates that
+        fail to compile fail again, with a proper error, when they are
+        rendered, and without a route index the rooms are looked up for
+        every delivery instead.
+        """
+        started = time.time()
+        templates = 0
+        try:
+            templates = precompile_templates()
+        except Exception as e:
+            self.log.exception(e)
+        try:
+            self.build_route_index()
+        except Exception as e:
+            self.route_index = None
+            self.log.exception(e)
+        finally:
+            self.timings['warmup'] = time.time() - started
+            self.log.info('Warm-up done in {0:.3f}s, compiled {1} '
+                          'templates'.format(self.timings['warmup'], templates))
+            with self.ready_lock:
+                pending, self.pending = self.pending, []
+                self.ready = True
+            for delivery in pending:
+                try:
+                    self.dispatch(*delivery)
+                except Exception as e:
+                    self.log.exception(e)
+
+    def deactivate(self):
+        with self.ready_lock:
+            pending, self.pending = self.pending, []
+        if pending:
+            self.log.warn('Deactivated with {0} queued deliveries, these are '
+                          'lost'.format(len(pending)))
+        if self.archive is not None:
+            self.archive.stop()
+            self.archive = None
+        super(RepoHook, self).deactivate()
 
     def get_configuration_template(self):
         return HELP_MSG
@@ -43,11 +158,80 @@ class RepoHook(BotPlugin):
         pass
 
     def configure(self, configuration):
-        if configuration is not None:
-            config = configuration
-        else:
-            config = DEFAULT_CONFIG
+        # A shared configuration is the source of truth, what errbot has
+        # stored for this instance may be outdated. It only seeds the shared
+        # state when that is still empty. Without shared state the
+        # configuration errbot passes in wins.
+        version, config = self.state.load_config()
+        if config is None or not self.state.shared:
+            seed = configuration
+            if seed is None:
+                seed = copy.deepcopy(DEFAULT_CONFIG)
+            saved = self.state.save_config(seed, version)
+            if saved is None:
+                # Another instance seeded it first, go with theirs.
+                version, config = self.state.load_config()
+            else:
+                version, config = saved, seed
+        self.config_version = version
         super(RepoHook, self).configure(config)
+        self.build_repo_index()
+
+    def refresh_config(self):
+        """Pick up configuration changes saved by another instance."""
+        version = self.state.config_version()
+        if version != self.config_version:
+            version, config = self.state.load_config()
+            if config is not None:
+                self.config = config
+                self.build_repo_index()
+                self.build_route_index()
+                self._bot.plugin_manager.set_plugin_configuration('RepoHook',
+                                                                  self.config)
+            self.config_version = version
+
+    def build_repo_index(self):
+        """Rebuild the sorted index of configured repositories.
+
+        The index is kept up to date by index_repo so listing commands never
+        have to sort the whole configuration again.
+        """
+        self.repo_index = sorted(self.config['repositories'])
+
+    def build_route_index(self):
+        """Rebuild the index of rooms by repository and event.
+
+        Relaying an event then only looks up the rooms that want it instead
+        of checking the events of every route of the repository.
+        """
+        self.route_index = dict(
+            (repo, self.index_routes(repo))
+            for repo in list(self.config['repositories']))
+
+    def index_routes(self, repo):
+        """Return the rooms of a repository's routes by event. Rooms
+        relaying all events are listed under `*` only."""
+        rooms = {}
+        for room in list(self.get_routes(repo)):
+            events = self.get_events(repo, room) or []
+            for event in ['*'] if '*' in events else events:
+                rooms.setdefault(event, []).append(room)
+        return rooms
+
+    def index_repo(self, repo):
+        """Update the indexes after the configuration of repo changed."""
+        index = bisect.bisect_left(self.repo_index, repo)
+        indexed = index < len(self.repo_index) and self.repo_index[index] == repo
+        if self.has_repo(repo) and not indexed:
+            self.repo_index.insert(index, repo)
+        elif not self.has_repo(repo) and indexed:
+            del self.repo_index[index]
+        if self.route_index is None:
+            return
+        if self.has_repo(repo):
+            self.route_index[repo] = self.index_routes(repo)
+        else:
+            self.route_index.pop(repo, None)
 
     #################################################################
     # Convenience methods to get, check or set configuration options.
@@ -56,14 +240,18 @@ class RepoHook(BotPlugin):
     def clear_repo(self, repo):
         """Completely remove a repository's configuration."""
         if self.has_repo(repo):
-            self.config['repositories'].pop(repo)
-            self.save_config()
+            def change(config):
+                config['repositories'].pop(repo, None)
+            self.save_config(change, repo)
 
     def clear_route(self, repo, room):
         """Remove a route from a repository."""
         if self.has_route(repo, room):
-            self.config['repositories'][repo]['routes'].pop(room)
-            self.save_config()
+            def change(config):
+                config['repositories'].get(repo, {}) \
+                                      .get('routes', {}) \
+                                      .pop(room, None)
+            self.save_config(change, repo)
 
     def has_repo(self, repo):
         """Check if the repository is known."""
@@ -92,6 +280,10 @@ class RepoHook(BotPlugin):
                                           .get(room, {}) \
                                           .get('events')
 
+    def get_global_route(self):
+        """Return the room global events are relayed to or None."""
+        return self.config.get('global_route')
+
     def get_repo(self, repo):
         """Return the repo's configuration or None."""
         return self.config['repositories'].get(repo)
@@ -100,6 +292,34 @@ class RepoHook(BotPlugin):
         """Return a list of all repositories we have configured."""
         return self.config['repositories'].keys()
 
+    def iter_repos(self, prefix='', room=None, after=None):
+        """Yield configured repositories in sorted order.
+
+        Only repositories starting with prefix and, if given, routing to room
+        are returned. When after is set iteration resumes right after that
+        repository, which is what the paginated commands use as cursor.
+        """
+        start = bisect.bisect_left(self.repo_index, prefix)
+        if after is not None:
+            start = max(start, bisect.bisect_right(self.repo_index, after))
+        for repo in self.repo_index[start:]:
+            if not repo.startswith(prefix):
+                break
+            if room is None or self.has_route(repo, room):
+                yield repo
+
+    def page_repos(self, prefix='', room=None, after=None, size=PAGE_SIZE):
+        """Return a page of repositories and the cursor for the next one.
+
+        The cursor is None when there is nothing left to show.
+        """
+        repos = []
+        for repo in self.iter_repos(prefix, room, after):
+            if len(repos) == size:
+                return repos, repos[-1]
+            repos.append(repo)
+        return repos, None
+
     def get_route(self, repo, room):
         """Return the configuration of this route."""
         return self.config['repositories'].get(repo, {}) \
@@ -114,6 +334,15 @@ class RepoHook(BotPlugin):
                                           .get('routes', {}) \
                                           .keys()
 
+    def get_summary(self, repo, room):
+        """Return the commit summary settings of a route, None when it
+        uses the defaults."""
+        route = self.get_route(repo, room) or {}
+        if 'commit_limit' not in route and not route.get('commit_aggregate'):
+            return None
+        return {'limit': route.get('commit_limit', COMMIT_LIMIT),
+                'aggregate': route.get('commit_aggregate', [])}
+
     def get_token(self, repo):
         """Returns the token for a repository.
 
@@ -124,37 +353,73 @@ class RepoHook(BotPlugin):
 
     def set_defaults(self, defaults):
         """Set which events are relayed by default."""
-        self.config['default_events'] = defaults
-        self.save_config()
+        def change(config):
+            config['default_events'] = defaults
+        self.save_config(change)
 
     def set_events(self, repo, room, events):
         """Set the events to be relayed for this combination of repository
         and room."""
-        self.config['repositories'][repo]['routes'][room]['events'] = events
-        self.save_config()
+        def change(config):
+            route = self.get_route(repo, room)
+            if route is not None:
+                route['events'] = events
+        self.save_config(change, repo)
+
+    def set_global_route(self, room):
+        """Set the room global events are relayed to, None for none."""
+        def change(config):
+            config['global_route'] = room
+        self.save_config(change)
+
+    def set_summary(self, repo, room, limit, aggregate):
+        """Set how the commits of a push are summarised for this route."""
+        def change(config):
+            route = self.get_route(repo, room)
+            if route is not None:
+                route['commit_limit'] = limit
+                route['commit_aggregate'] = aggregate
+        self.save_config(change)
 
     def set_route(self, repo, room):
         """Create a configuration entry for this route.
 
         If the repository is unknown to us, add the repository first.
         """
-        if self.get_repo(repo) is None:
-            self.config['repositories'][repo] = { 'routes': {}, 'token': None }
-        self.config['repositories'][repo]['routes'][room] = {}
-        self.save_config()
+        def change(config):
+            config['repositories'].setdefault(
+                repo, { 'routes': {}, 'token': None })['routes'][room] = {}
+        self.save_config(change, repo)
 
     def set_token(self, repo, token):
         """Set the token for a repository."""
-        self.config['repositories'][repo]['token'] = token
-        self.save_config()
+        def change(config):
+            if self.has_repo(repo):
+                config['repositories'][repo]['token'] = token
+        self.save_config(change)
 
-    def save_config(self):
-        """Save the current configuration.
+    def save_config(self, change, repo=None):
+        """Apply change to the configuration and save it.
 
         This method takes care of saving the configuration since we can't
         use !config RepoHook <configuration blob> to configure this
         plugin.
+
+        change is called with the configuration to modify in place. It is
+        only saved if no other instance saved the configuration since we
+        loaded it, otherwise their changes are loaded and change is applied
+        again. Pass the repository whose routes change, if any, to keep the
+        indexes up to date.
         """
+        while True:
+            change(self.config)
+            version = self.state.save_config(self.config, self.config_version)
+            if version is not None:
+                break
+            self.refresh_config()
+        self.config_version = version
+        if repo is not None:
+            self.index_repo(repo)
         self._bot.plugin_manager.set_plugin_configuration('RepoHook',
                                                           self.config)
 
@@ -185,6 +450,8 @@ class RepoHook(BotPlugin):
         message.append('This plugin has multiple commands: ')
         message.append(' • config: to display the full configuration of '
                        'this plugin (not human friendly)')
+        message.append(' • config `[prefix:<prefix>] [room:<room>] '
+                       '[after:<repo>]`: to page through the configuration')
         message.append(' • route `<repo> <room>`: to relay messages from '
                        '`<repo>` to `<room>` for events '
                        '{0}'.format(md_escape(' '.join(self.get_defaults()))))
@@ -192,6 +459,8 @@ class RepoHook(BotPlugin):
                        'messages from `<repo>` to `<room>` for `<events>`')
         message.append(' • routes `<repo>`: show routes for this repository')
         message.append(' • routes: to display all routes')
+        message.append(' • routes `[prefix:<prefix>] [room:<room>] '
+                       '[after:<repo>]`: to page through the routes')
         message.append(' • global route <room>: to set a route for global events')
         message.append(' • defaults <events>: to configure the events we '
                        'should forward by default')
@@ -199,25 +468,79 @@ class RepoHook(BotPlugin):
                        'by default')
         message.append(' • token `<repo>`: to configure the repository '
                        'secret')
+        message.append(' • history `<repo> [event] [since]`: to show the '
+                       'latest events of a repository, e.g. since `1h`')
+        message.append(' • status: to show startup timings')
+        message.append(' • summary `<repo> <room> <limit> [authors] [paths]`: '
+                       'to list at most `<limit>` commits of a push and '
+                       'optionally count their authors and paths')
         message.append('Please see {0} for more information.'.format(README))
         return '\n'.join(message)
 
-    @botcmd(admin_only=True)
-    def repohook_config(self, *args):
-        """Returns the current configuration of the plugin."""
+    @staticmethod
+    def parse_filters(args):
+        """Split command arguments into plain arguments and filters.
+
+        Filters are passed as `key:value`, e.g. `prefix:example/` or
+        `room:example@example.com`. Only prefix, room and after are known,
+        anything else is considered a plain argument.
+        """
+        plain = []
+        filters = {}
+        for arg in args:
+            key, sep, value = arg.partition(':')
+            if sep and key in ('prefix', 'room', 'after'):
+                filters[key] = value
+            else:
+                plain.append(arg)
+        return plain, filters
+
+    @staticmethod
+    def next_page(command, filters, cursor):
+        """Build the hint on how to fetch the next page."""
+        args = ['{0}:{1}'.format(key, filters[key])
+                for key in ('prefix', 'room') if filters.get(key)]
+        args.append('after:{0}'.format(cursor))
+        return NEXT_PAGE.format(config.BOT_PREFIX, command, ' '.join(args))
+
+    @botcmd(admin_only=True, split_args_with=None)
+    def repohook_config(self, message, args):
+        """Returns the current configuration of the plugin.
+
+        The configuration is sent one repository per message and a page at a
+        time, use the prefix, room and after filters to get to the rest.
+        """
+        self.refresh_config()
+        _, filters = self.parse_filters(args)
         # pprint can't deal with nested dicts, json.dumps is aces.
-        return json.dumps(self.config, indent=4, sort_keys=True)
+        if 'after' not in filters:
+            yield json.dumps({'default_events': self.get_defaults(),
+                              'global_route': self.get_global_route()},
+                             indent=4, sort_keys=True)
+        repos, cursor = self.page_repos(filters.get('prefix', ''),
+                                        filters.get('room'),
+                                        filters.get('after'))
+        for repo in repos:
+            yield json.dumps({repo: self.get_repo(repo)},
+                             indent=4, sort_keys=True)
+        if cursor is not None:
+            yield self.next_page('config', filters, cursor)
 
     @botcmd(admin_only=True)
     def repohook_reset(self, *args):
         """Nuke the complete configuration."""
-        self.config = DEFAULT_CONFIG
-        self.save_config()
+        def change(config):
+            config.clear()
+            config.update(copy.deepcopy(DEFAULT_CONFIG))
+        self.save_config(change)
+        self.build_repo_index()
+        self.build_route_index()
         return 'Done. All configuration has been expunged.'
 
     @botcmd(split_args_with=None)
     def repohook_defaults(self, message, args):
         """Get or set what events are relayed by default for new routes."""
+        self.refresh_config()
         if args:
             events = []
             for event in args:
@@ -242,6 +565,7 @@ class RepoHook(BotPlugin):
         If you do not specify a list of events the route will default to
         receiving the events configured as 'default_events'.
         """
+        self.refresh_config()
         if len(args) >= 2:
             repo = args[0]
             room = args[1]
@@ -271,20 +595,33 @@ class RepoHook(BotPlugin):
 
     @botcmd(split_args_with=None)
     def repohook_routes(self, message, args):
-        """Displays the routes for one, multiple or all repositories."""
-        if args:
-            for repo in args:
+        """Displays the routes for one, multiple or all repositories.
+
+        Without any repositories the routes are shown a page at a time,
+        optionally filtered by repository prefix and room.
+        """
+        self.refresh_config()
+        repos, filters = self.parse_filters(args)
+        if repos:
+            for repo in repos:
                 if self.has_repo(repo):
                     yield self.show_repo_config(repo)
                 else:
                     yield REPO_UNKNOWN.format(repo)
         else:
-            repos = self.get_repos()
+            repos, cursor = self.page_repos(filters.get('prefix', ''),
+                                            filters.get('room'),
+                                            filters.get('after'))
             if repos:
-                yield ("You asked for it, here are all the repositories, the "
-                       "rooms and associated events that are relayed:")
+                if 'after' not in filters:
+                    yield ("You asked for it, here are all the repositories, "
+                           "the rooms and associated events that are relayed:")
                 for repo in repos:
                     yield self.show_repo_config(repo)
+                if cursor is not None:
+                    yield self.next_page('routes', filters, cursor)
+            elif filters:
+                yield 'No repositories match, nothing to show.'
             else:
                 yield 'No repositories configured, nothing to show.'
 
@@ -296,6 +633,7 @@ class RepoHook(BotPlugin):
         the repository. It must be configured on your repository's webhook
         settings too.
         """
+        self.refresh_config()
         if len(args) != 2:
             return HELP_MSG
         else:
@@ -319,6 +657,7 @@ class RepoHook(BotPlugin):
         removed too. With only one route remaining this essentially achieves
         the same result as calling this with only the repository as argument.
         """
+        self.refresh_config()
         if len(args) == 1:
             repo = args[0]
             self.clear_repo(repo)
@@ -335,15 +674,113 @@ class RepoHook(BotPlugin):
         else:
             yield HELP_MSG
 
+    @botcmd(split_args_with=None)
+    def repohook_summary(self, message, args):
+        """Get or set how the commits of a push are summarised for a route.
+
+        This takes a repository, a chatroom and optionally the number of
+        commits to list, at most MAX_COMMIT_LIMIT, followed by what to
+        aggregate: authors, paths or both.
+        """
+        self.refresh_config()
+        if len(args) < 2:
+            yield HELP_MSG
+            return
+        repo = args[0]
+        room = args[1]
+        if not self.has_route(repo, room):
+            yield 'There is no route for `{0}` to `{1}`.'.format(repo, room)
+            return
+
+        if len(args) > 2:
+            try:
+                limit = int(args[2])
+            except ValueError:
+                yield HELP_MSG
+                return
+            if limit > MAX_COMMIT_LIMIT:
+                yield ('Listing at most {0} commits, the most a route '
+                       'can list.'.format(MAX_COMMIT_LIMIT))
+            aggregate = []
+            for arg in args[3:]:
+                if arg in AGGREGATES:
+                    aggregate.append(arg)
+                else:
+                    yield 'Unknown aggregate `{0}`, skipping.'.format(arg)
+            self.set_summary(repo, room, min(max(limit, 0), MAX_COMMIT_LIMIT),
+                             aggregate)
+
+        summary = self.get_summary(repo, room) or {'limit': COMMIT_LIMIT,
+                                                   'aggregate': []}
+        yield ('Pushes from `{0}` to `{1}` list at most {2} commits{3}.'.format(
+            repo, room, summary['limit'],
+            ', counting {0}'.format(' and '.join(summary['aggregate']))
+            if summary['aggregate'] else ''))
+
+    @botcmd(admin_only=True, split_args_with=None)
+    def repohook_history(self, message, args):
+        """Show the most recent events received for a repository.
+
+        This takes a repository and optionally an event type and how far
+        back to look, as a number followed by s, m, h, d or w. Since this
+        shows what was relayed to any room it is restricted to admins.
+        """
+        if self.archive is None:
+            yield ARCHIVE_DISABLED
+            return
+        if not 1 <= len(args) <= 3:
+            yield HELP_MSG
+            return
+
+        repo = args[0]
+        event_type = None
+        since = None
+        for arg in args[1:]:
+            match = DURATION.match(arg)
+            if match:
+                since = time.time() - int(match.group(1)) * \
+                    DURATION_UNITS[match.group(2)]
+            else:
+                event_type = EVENT_ALIASES.get(arg, arg)
+
+        events = self.archive.query(repo, event_type, since, HISTORY_LIMIT)
+        if not events:
+            yield HISTORY_EMPTY.format(repo)
+            return
+        lines = ['Latest events for `{0}`:'.format(repo)]
+        for received_at, event, text in events:
+            lines.append(' • {0} `{1}`: {2}'.format(
+                time.strftime('%Y-%m-%d %H:%M:%S UTC', time.gmtime(received_at)),
+                event, text.split('\n', 1)[0]))
+        yield '\n'.join(lines)
+
+    @botcmd
+    def repohook_status(self, *args):
+        """Report how long activation, warm-up and the first delivery
+        took."""
+        message = ['Activation took {0:.3f}s.'.format(
+            self.timings.get('activation', 0))]
+        if 'warmup' in self.timings:
+            message.append('Warm-up took {0:.3f}s.'.format(
+                self.timings['warmup']))
+        else:
+            message.append('Warming up, {0} deliveries queued.'.format(
+                len(self.pending)))
+        if 'first_delivery' in self.timings:
+            message.append('The first delivery took {0:.3f}s.'.format(
+                self.timings['first_delivery']))
+        return '\n'.join(message)
+
     @botcmd(split_args_with=None)
     def repohook_global(self, message, args):
         """Set a global route"""
+        self.refresh_config()
         if len(args) == 1:
-            self['global_route ']= None
+            self.set_global_route(None)
             yield 'Removed global route.'
         elif len(args) == 2:
             room = args[1]
-            self['global_route'] = room
+            self.set_global_route(room)
             yield 'Set global route to {}.'.format(room)
         else:
             yield HELP_MSG
@@ -358,19 +795,17 @@ class RepoHook(BotPlugin):
         of a sensible message to a function specific to this event. If no such
         function exists, use a generic message function.
 
-        Once we have a message, route it to the appropriate channels.
+        Once we have a message, route it to the appropriate channels. Until
+        the warm-up is done validated deliveries are queued instead.
         """
+        received_at = time.time()
 
         if not self.validate_incoming(request):
             self.log.warn('Request is invalid {0}'.format(str(vars(request))))
             abort(400)
 
-        if 'X-Github-Event' in request.headers:
-            event_type = request.get_header('X-Github-Event').lower()
-            provider = getattr(self, 'github')
-        elif 'X-Gitlab-Event' in request.headers:
-            event_type = request.get_header('X-Gitlab-Event').replace(' ', '_').lower()
-            provider = getattr(self, 'gitlab')
+        provider = self.get_provider(request)
+        event_type = provider.get_event_type(request)
 
         body = request.json
 
@@ -379,6 +814,7 @@ class RepoHook(BotPlugin):
             response.status = 204
             return None
 
+        self.refresh_config()
         repo = provider.get_repo(body)
         global_event = self.is_global_event(event_type, repo, body)
 
@@ -411,25 +847,122 @@ class RepoHook(BotPlugin):
                 self.log.warn('Event received for {0} from {1} but could not validate it.'.format(repo, ip))
             abort(403)
 
+        # Without a delivery ID from the provider the payload itself
+        # identifies the delivery.
+        delivery_id = provider.get_delivery_id(request) or \
+            hashlib.sha1(request.body.read()).hexdigest()
+
+        delivery = (provider, event_type, body, repo, global_event, delivery_id,
+                    received_at)
+        if not self.ready:
+            with self.ready_lock:
+                if not self.ready:
+                    if len(self.pending) >= PENDING_LIMIT:
+                        self.log.warn('Warming up with {0} deliveries queued, '
+                                      'refusing delivery for {1}'.format(
+                                          len(self.pending), repo))
+                        abort(503)
+                    self.pending.append(delivery)
+                    response.status = 202
+                    return None
+
+        self.dispatch(*delivery)
+        response.status = 204
+        return None
+
+    def dispatch(self, provider, event_type, body, repo, global_event,
+                 delivery_id, received_at):
+        """Relay a delivery unless another instance already claimed it.
+
+        Should relaying it fail the claim is released, so a retry of the
+        delivery gets another chance on any instance. Without shared state
+        there is no other instance and deliveries aren't claimed at all, so
+        redelivering one by hand relays it again.
+        """
+        if not self.state.shared:
+            self.relay(provider, event_type, body, repo, global_event,
+                       delivery_id)
+        else:
+            claim = 'delivery:' + delivery_id
+            if not self.state.claim(claim, DELIVERY_TTL):
+                self.log.info('Delivery {0} for {1} already relayed, '
+                              'skipping'.format(delivery_id, repo))
+                return
+            try:
+                self.relay(provider, event_type, body, repo, global_event,
+                           delivery_id)
+            except Exception:
+                self.state.release(claim)
+                raise
+
+        if 'first_delivery' not in self.timings:
+            self.timings['first_delivery'] = time.time() - received_at
+            self.log.info('First delivery since activation took {0:.3f}s'.format(
+                self.timings['first_delivery']))
+
+    def relay(self, provider, event_type, body, repo, global_event,
+              delivery_id):
+        """Create the message for an event and send it to its routes."""
         message = provider.create_message(body, event_type, repo)
         self.log.debug('Prepared message: {0}'.format(message))
+        if message and self.archive is not None:
+            # Archive GitLab's push_hook as push and so on, so history
+            # queries use the same names for every provider.
+            self.archive.record(
+                repo, provider.event_aliases.get(event_type, event_type), message)
 
         # - if we have a message and is it not empty or None
-        # - get all rooms for the repository we received the event for
-        # - check if we should deliver this event
+        # - look up the rooms of the repository that want this event
+        # - render it again if the route summarises commits differently,
+        #   once for every distinct setting
         # - join the room (this won't do anything if we're already joined)
         # - send the message
         if message and message is not None:
-            for room_name in self.get_routes(repo):
-                events = self.get_events(repo, room_name)
-                self.log.debug('Routes for room {0}: {1}'.format(room_name, events))
-                if event_type in events or '*' in events:
-                    self.join_and_send(room_name, message)
-            if global_event and 'global_route' in self:
-                self.join_and_send(self['global_route'], message)
-        response.status = 204
+            messages = {None: message}
+            if self.route_index is not None:
+                rooms = self.route_index.get(repo, {})
+            else:
+                rooms = self.index_routes(repo)
+            room_names = rooms.get(event_type, []) + rooms.get('*', [])
+            self.log.debug('Rooms for {0}: {1}'.format(event_type, room_names))
+            for room_name in room_names:
+                summary = None
+                if event_type in provider.summarized:
+                    summary = self.get_summary(repo, room_name)
+                key = summary and (summary['limit'],
+                                   tuple(summary['aggregate']))
+                if key not in messages:
+                    messages[key] = provider.create_message(
+                        body, event_type, repo, summary)
+                if messages[key]:
+                    self.send_once(room_name, messages[key], delivery_id)
+            if global_event and self.get_global_route() is not None:
+                self.send_once(self.get_global_route(), message, delivery_id)
+
+    def get_provider(self, request):
+        """Return the provider whose event header is set on the request."""
+        for provider in self.providers:
+            if provider.event_header in request.headers:
+                return provider
         return None
 
+    def send_once(self, room_name, message, delivery_id):
+        """Send the message unless the lease on sending this delivery to
+        the room is already held by another instance."""
+        if not self.state.shared:
+            self.join_and_send(room_name, message)
+            return
+        lease = 'lease:{0}:{1}'.format(room_name, delivery_id)
+        if self.state.claim(lease, LEASE_TTL):
+            try:
+                self.join_and_send(room_name, message)
+            except Exception:
+                self.state.release(lease)
+                raise
+        else:
+            self.log.info('Delivery {0} to {1} already sent, '
+                          'skipping'.format(delivery_id, room_name))
+
     def join_and_send(self, room_name, message):
         room = self.query_room(room_name)
         try:
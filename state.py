@@ -0,0 +1,222 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+import copy
+import json
+import sqlite3
+import threading
+import time
+
+# Drop expired claims once every this many claims.
+PRUNE_INTERVAL = 1000
+
+SCHEMA = [
+    'CREATE TABLE IF NOT EXISTS config ('
+    ' id INTEGER PRIMARY KEY CHECK (id = 0),'
+    ' version INTEGER NOT NULL,'
+    ' config TEXT)',
+    'INSERT OR IGNORE INTO config (id, version, config) VALUES (0, 0, NULL)',
+    'CREATE TABLE IF NOT EXISTS claims ('
+    ' key TEXT PRIMARY KEY,'
+    ' expires_at REAL NOT NULL)',
+    'CREATE INDEX IF NOT EXISTS claims_expiry ON claims (expires_at)',
+]
+
+
+def get_state(url):
+    """Return the shared state backend for url.
+
+    No url keeps the state in this process, which is all a single instance
+    needs. `redis://` urls use Redis and anything else is taken as the path
+    of a SQLite database shared by the instances running on this host.
+    """
+    if not url:
+        return MemoryState()
+    if url.startswith(('redis://', 'rediss://', 'unix://')):
+        return RedisState(url)
+    if url.startswith('file://'):
+        url = url[len('file://'):]
+    return SQLiteState(url)
+
+
+class MemoryState(object):
+    """State shared between the threads of a single instance.
+
+    Every backend holds the route configuration, along with a version that
+    changes whenever it is saved, and a set of claims. A claim on a key is
+    granted to exactly one caller until it expires or is released, which is
+    what delivery deduplication and room send leases are built on.
+
+    Backends that are shared with other instances set shared.
+    """
+
+    shared = False
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.version = 0
+        self.config = None
+        self.claims = {}
+        self.claimed = 0
+
+    def config_version(self):
+        return self.version
+
+    def load_config(self):
+        """Return the version and a copy of the configuration, or None if
+        it was never saved."""
+        with self.lock:
+            return self.version, copy.deepcopy(self.config)
+
+    def save_config(self, config, version=None):
+        """Store the configuration and return its new version.
+
+        When version is given the configuration is only stored if that is
+        still the current version, otherwise None is returned.
+        """
+        with self.lock:
+            if version is not None and version != self.version:
+                return None
+            self.version += 1
+            self.config = copy.deepcopy(config)
+            return self.version
+
+    def claim(self, key, ttl):
+        """Claim key for ttl seconds, return False if it's already taken."""
+        now = time.time()
+        with self.lock:
+            self.claimed += 1
+            if self.claimed % PRUNE_INTERVAL == 0:
+                self.claims = dict((k, expiry) for k, expiry
+                                   in self.claims.items() if expiry > now)
+            if self.claims.get(key, 0) > now:
+                return False
+            self.claims[key] = now + ttl
+            return True
+
+    def release(self, key):
+        """Give up a claim so the key can be claimed again."""
+        with self.lock:
+            self.claims.pop(key, None)
+
+
+class SQLiteState(object):
+    """State shared through a SQLite database by the instances on one host.
+
+    The configuration is a single row, so reading its version is cheap, and
+    every claim is a row of its own indexed on expiry.
+    """
+
+    shared = True
+
+    def __init__(self, path):
+        self.path = path
+        self.local = threading.local()
+        self.claimed = 0
+        connection = self.connect()
+        with connection:
+            for statement in SCHEMA:
+                connection.execute(statement)
+
+    def connect(self):
+        """Return the connection of the calling thread."""
+        connection = getattr(self.local, 'connection', None)
+        if connection is None:
+            connection = sqlite3.connect(self.path, timeout=30)
+            connection.execute('PRAGMA journal_mode=WAL')
+            self.local.connection = connection
+        return connection
+
+    def config_version(self):
+        return self.connect().execute(
+            'SELECT version FROM config WHERE id = 0').fetchone()[0]
+
+    def load_config(self):
+        version, config = self.connect().execute(
+            'SELECT version, config FROM config WHERE id = 0').fetchone()
+        if config is None:
+            return version, None
+        return version, json.loads(config)
+
+    def save_config(self, config, version=None):
+        connection = self.connect()
+        with connection:
+            if version is None:
+                connection.execute(
+                    'UPDATE config SET version = version + 1, config = ? '
+                    'WHERE id = 0', (json.dumps(config), ))
+            elif connection.execute(
+                    'UPDATE config SET version = version + 1, config = ? '
+                    'WHERE id = 0 AND version = ?',
+                    (json.dumps(config), version)).rowcount == 0:
+                return None
+            return connection.execute(
+                'SELECT version FROM config WHERE id = 0').fetchone()[0]
+
+    def claim(self, key, ttl):
+        now = time.time()
+        connection = self.connect()
+        self.claimed += 1
+        with connection:
+            if self.claimed % PRUNE_INTERVAL == 0:
+                connection.execute('DELETE FROM claims WHERE expires_at <= ?',
+                                   (now, ))
+            else:
+                connection.execute('DELETE FROM claims WHERE key = ? AND '
+                                   'expires_at <= ?', (key, now))
+            return connection.execute(
+                'INSERT OR IGNORE INTO claims (key, expires_at) VALUES (?, ?)',
+                (key, now + ttl)).rowcount == 1
+
+    def release(self, key):
+        connection = self.connect()
+        with connection:
+            connection.execute('DELETE FROM claims WHERE key = ?', (key, ))
+
+
+class RedisState(object):
+    """State shared through Redis by instances on any number of hosts.
+
+    This needs the redis package, which is only imported when this backend
+    is configured.
+    """
+
+    prefix = 'repohook:'
+    shared = True
+
+    def __init__(self, url):
+        import redis
+        self.redis = redis.StrictRedis.from_url(url)
+        self.WatchError = redis.WatchError
+
+    def config_version(self):
+        return int(self.redis.get(self.prefix + 'config_version') or 0)
+
+    def load_config(self):
+        pipe = self.redis.pipeline()
+        pipe.get(self.prefix + 'config_version')
+        pipe.get(self.prefix + 'config')
+        version, config = pipe.execute()
+        if config is None:
+            return int(version or 0), None
+        return int(version or 0), json.loads(config.decode('utf-8'))
+
+    def save_config(self, config, version=None):
+        key = self.prefix + 'config_version'
+        with self.redis.pipeline() as pipe:
+            try:
+                pipe.watch(key)
+                if version is not None and int(pipe.get(key) or 0) != version:
+                    return None
+                pipe.multi()
+                pipe.set(self.prefix + 'config', json.dumps(config))
+                pipe.incr(key)
+                return pipe.execute()[1]
+            except self.WatchError:
+                return None
+
+    def claim(self, key, ttl):
+        return bool(self.redis.set(self.prefix + 'claim:' + key, 1,
+                                   nx=True, ex=int(ttl)))
+
+    def release(self, key):
+        self.redis.delete(self.prefix + 'claim:' + key)